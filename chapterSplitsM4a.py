@@ -8,6 +8,7 @@ import argparse
 import datetime as DT
 import functools as fn
 import json
+import mmap
 import os
 import os.path as path
 import pathlib
@@ -17,6 +18,16 @@ import sys
 import time
 import unicodedata
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from mutagen.mp4 import MP4
+
+try:
+    import orjson
+
+    hasOrjson = True
+except ImportError:
+    hasOrjson = False
 
 
 def parseArgs():
@@ -27,6 +38,13 @@ def parseArgs():
         else:
             raise argparse.ArgumentTypeError("Invalid Directory path")
 
+    def jobCount(num):
+        num = int(num)
+        if num >= 1:
+            return num
+        else:
+            raise argparse.ArgumentTypeError("Jobs must be at least 1")
+
     parser = argparse.ArgumentParser(
         description="Split m4a files with bookmarks using ffmpeg."
     )
@@ -58,6 +76,13 @@ def parseArgs():
         type=int,
         help="Wait time in seconds between each iteration, default is 10",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=jobCount,
+        help="Number of chapters to tag in parallel, default is cpu count.",
+    )
     pargs = parser.parse_args()
 
     return pargs
@@ -68,13 +93,14 @@ secondsToHMS = lambda sec: str(DT.timedelta(seconds=sec))
 
 def makeTargetDirs(name, dirPath):
     newPath = dirPath.joinpath(name)
-    if not newPath.exists():
-        os.mkdir(newPath)
+    newPath.mkdir(exist_ok=True)
     return newPath
 
 
 def nSort(s, _nsre=re.compile("([0-9]+)")):
-    return [int(text) if text.isdigit() else text.lower() for text in _nsre.split(s)]
+    return tuple(
+        int(text) if text.isdigit() else text.lower() for text in _nsre.split(s)
+    )
 
 
 def printLog(data, logRef):
@@ -83,82 +109,221 @@ def printLog(data, logRef):
 
 
 def getInput():
-    print("\nPress Enter Key continue or input 'e' to exit.")
-    try:
+    while True:
+        print("\nPress Enter Key continue or input 'e' to exit.")
         choice = input("\n> ")
-        if choice not in ["e", ""]:
-            raise ValueError
-
-    except ValueError:
+        if choice in ("e", ""):
+            return choice
         print("\nInvalid input.")
-        choice = getInput()
-
-    return choice
 
 
 def wait(sec):
-    print(f"\nWaiting for {str(sec)} seconds.\n>")
+    print(f"\nWaiting for {sec} seconds.\n>")
     time.sleep(int(sec))
 
 
+slugReplace = {"[": "(", "]": ")", ":": "_", "()": ""}
+slugInvalid = re.compile(r"[^\w\s)(_-]")
+slugSpaces = re.compile(r"[\s]+")
+slugDashSpaces = re.compile(r"[-\s]+")
+
+
 def slugify(value, replace={}, keepSpace=True):
     """
     Adapted from django.utils.text.slugify
     https://docs.djangoproject.com/en/3.0/_modules/django/utils/text/#slugify
     """
-    replace.update({"[": "(", "]": ")", ":": "_", "()": ""})
-    value = str(value)
-    value = (
-        unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
-    )
+    replace = {**replace, **slugReplace}
+    return _slugify(str(value), tuple(replace.items()), keepSpace)
 
-    for k, v in replace.items():
-        value = value.replace(k, v)
-    value = re.sub(r"[^\w\s)(_-]", "", value).strip()
+
+@fn.lru_cache(maxsize=None)
+def slugSteps(replace):
+    """
+    Merge runs of single char replacements into one str.translate table,
+    keeping the result identical to applying each str.replace in order.
+    """
+    steps, table = [], {}
+    for k, v in replace:
+        if len(k) == 1 and len(v) <= 1 and k not in table.values():
+            table[k] = v
+            continue
+        if table:
+            steps.append(str.maketrans(table))
+            table = {}
+        if len(k) == 1 and len(v) <= 1:
+            table[k] = v
+        else:
+            steps.append((k, v))
+    if table:
+        steps.append(str.maketrans(table))
+    return tuple(steps)
+
+
+@fn.lru_cache(maxsize=4096)
+def _slugify(value, replace, keepSpace):
+    if not value.isascii():
+        value = (
+            unicodedata.normalize("NFKD", value)
+            .encode("ascii", "ignore")
+            .decode("ascii")
+        )
+
+    for step in slugSteps(replace):
+        if isinstance(step, dict):
+            value = value.translate(step)
+        else:
+            value = value.replace(*step)
+    value = slugInvalid.sub("", value).strip()
 
     if keepSpace:
-        value = re.sub(r"[\s]+", " ", value)
+        value = slugSpaces.sub(" ", value)
     else:
-        value = re.sub(r"[-\s]+", "-", value)
+        value = slugDashSpaces.sub("-", value)
     return value
 
 
-getFileList = lambda dirPath: [
-    x for x in dirPath.iterdir() if x.is_file() and ".info.json" in x.name
-]
+def getFileList(dirPath):
+    """
+    Pair every .info.json with its .m4a (None if missing) in one directory
+    scan. DirEntry caches the file type from readdir, no extra stat calls.
+    """
+    infos, m4as = {}, {}
+    with os.scandir(dirPath) as it:
+        for e in it:
+            if not e.is_file():
+                continue
+            if e.name.endswith(".info.json"):
+                infos[e.name[: -len(".info.json")]] = pathlib.Path(e.path)
+            elif e.name.endswith(".m4a"):
+                m4as[e.name[: -len(".m4a")]] = pathlib.Path(e.path)
+    return [(info, m4as.get(name)) for name, info in infos.items()]
 
 
 def HMSToMS(time):
-    timeArr = [int(e) for e in time.split(":")]
-    if timeArr[0] != 0:
-        for h in range(timeArr[0] - 1):
-            timeArr[1] += 60
-    timeStr = [str(e).zfill(2) for e in timeArr[1:]]
-    return ":".join(timeStr)
+    h, m, s = time.split(":")
+    # Seconds may carry a fraction, cue INDEX only takes whole seconds here.
+    return f"{int(h) * 60 + int(m):02d}:{int(float(s)):02d}"
+
+
+jsonKeys = ("creator", "uploader", "title", "chapters")
 
 
 def getJson(file):
-    with open(file, "r", encoding="utf-8") as f:
-        return json.loads(f.read())
+    # Both parsers take the raw utf-8 bytes, no need to decode to str first.
+    with open(file, "rb") as f:
+        if not hasOrjson:
+            js = json.loads(f.read())
+        else:
+            try:
+                # orjson reads straight from the mapped pages, no heap copy.
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as buf:
+                        js = orjson.loads(buf)
+            except json.JSONDecodeError:
+                # orjson rejects NaN/Infinity and ints wider than 64 bits,
+                # which json.dump (used by yt-dlp) can write.
+                f.seek(0)
+                js = json.loads(f.read())
+    # Keep only the fields used below so the rest of the document
+    # (formats, thumbnails, subtitles etc.) can be freed right away.
+    return {k: js[k] for k in jsonKeys if k in js}
+
+
+segmentPattern = "_split_%03d.m4a"
+segmentList = "_split.txt"
+
+
+def splitChapters(m4aFile, chapters, extractDir):
+    start = chapters[0]["start_time"]
+    # Boundaries are relative to the -ss seek point, a single chapter is cut
+    # at its own end so the segment muxer does not fall back to 2s segments.
+    cuts = [c["start_time"] - start for c in chapters[1:]] or [
+        chapters[-1]["end_time"] - start
+    ]
+    return subprocess.Popen(
+        [
+            "ffmpeg",
+            "-ss",
+            str(start),
+            "-to",
+            str(chapters[-1]["end_time"]),  # --ss -to needs to be prior to -i
+            "-i",
+            m4aFile,
+            "-map",
+            "0:a",
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_times",
+            ",".join(str(c) for c in cuts),
+            "-reset_timestamps",
+            "1",
+            "-segment_list",
+            path.join(extractDir, segmentList),
+            "-segment_list_type",
+            "flat",
+            "-loglevel",
+            "warning",
+            path.join(extractDir, segmentPattern),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        encoding="utf-8",
+        errors="replace",
+    )
+
+
+def getSegments(extractDir):
+    """
+    Read back the segments ffmpeg actually wrote, in order. Chapters past the
+    end of the audio produce no segment, so names can not be assumed.
+    """
+    listFile = path.join(extractDir, segmentList)
+    with open(listFile, "r", encoding="utf-8") as f:
+        segments = [path.join(extractDir, line.strip()) for line in f if line.strip()]
+    os.remove(listFile)
+    return segments
+
+
+def tagChapter(task):
+    segment, track, title, artist, album, extractDir = task
+    fileName = f"{track}. {title}.m4a"
+    target = path.join(extractDir, fileName)
+    os.replace(segment, target)
+    # Segments are already stream copies, only the ilst atoms need writing.
+    audio = MP4(target)
+    audio["\xa9nam"] = [title]
+    audio["\xa9ART"] = [artist]
+    audio["aART"] = [artist]
+    audio["\xa9alb"] = [album]
+    audio["trkn"] = [(track, 0)]
+    audio.save()
+    return track, fileName
 
 
 pargs = parseArgs()
 
+jobs = pargs.jobs or os.cpu_count() or 1
+
 dirPath = pargs.dir.resolve()
 
-fileList = sorted(getFileList(dirPath), key=lambda k: nSort(str(k.stem)))
+fileList = sorted(getFileList(dirPath), key=lambda k: nSort(k[0].stem))
 
 if not fileList:
     print("Nothing to do.")
     sys.exit()
 
-for file in fileList:
+logsDir = makeTargetDirs("logs", dirPath)
+
+artistDirs = {}
 
-    baseName = str(file.name).replace(".info.json", "")
+for file, m4aFile in fileList:
 
-    m4aFile = dirPath.joinpath(f"{baseName}.m4a")
+    baseName = file.name.replace(".info.json", "")
 
-    if not m4aFile.exists():
+    if m4aFile is None:
         print(f"\n\n\nNo matching m4a file found for {file}")
         continue
 
@@ -172,9 +337,7 @@ for file in fileList:
         artist = slugify(js["creator"] or js["uploader"])
         album = slugify(js["title"])
 
-    logsDir = makeTargetDirs("logs", dirPath)
-
-    log = open(logsDir.joinpath(f"{baseName}.log"), "w")
+    log = open(logsDir.joinpath(f"{baseName}.log"), "w", buffering=1 << 16)
 
     printLogP = fn.partial(printLog, logRef=log)
     printLogP("\n\n==============================")
@@ -182,65 +345,77 @@ for file in fileList:
 
     if not isinstance(js["chapters"], Iterable):
         printLogP(f"\n\n\nSkipping {album}, Chapters info not found.")
+        log.close()
         continue
 
+    cueParts = None
     if not pargs.no_write:
         if pargs.gen_cue:
-            cue = dirPath.joinpath(f"{baseName}.cue")
-            with open(cue, "w") as f:
-                f.write(f'\nPERFORMER "{artist}"')
-                f.write(f'\nTITLE "{album}"')
-                f.write(f'\nFILE "{m4aFile.name}" AAC')
+            # Collected for the whole album and written out in one go.
+            cueParts = [
+                f'\nPERFORMER "{artist}"',
+                f'\nTITLE "{album}"',
+                f'\nFILE "{m4aFile.name}" AAC',
+            ]
         else:
-            artistDir = makeTargetDirs(artist, dirPath)
-            extractDir = makeTargetDirs(album, artistDir)
+            if artist not in artistDirs:
+                artistDirs[artist] = makeTargetDirs(artist, dirPath)
+            extractDir = makeTargetDirs(album, artistDirs[artist])
             printLogP(f"\nOutput directory name: {extractDir}")
 
+    tasks = []
     for i, chapter in enumerate(js["chapters"]):
         startTime = secondsToHMS(chapter["start_time"])
         endTime = secondsToHMS(chapter["end_time"])
         title = slugify(chapter["title"])
         track = i + 1
-        fileName = f"{track}. {title}.m4a"
         printLogP("\n\n------------------------------")
         printLogP(f"\n\nProcessing {title} from {startTime} to {endTime}")
         if pargs.no_write:
             continue
 
         if pargs.gen_cue:
-            with open(cue, "a") as f:
-                f.write(f"\n  TRACK {str(track).zfill(2)} AUDIO")
-                f.write(f'\n    TITLE "{title}"')
-                f.write(f"\n    INDEX 01 {HMSToMS(startTime)}:00 ")
+            cueParts.append(
+                f"\n  TRACK {track:02d} AUDIO"
+                f'\n    TITLE "{title}"'
+                f"\n    INDEX 01 {HMSToMS(startTime)}:00 "
+            )
         else:
-            printLogP(f"\nOutput file name: {fileName}")
-            out = subprocess.check_output(
-                [
-                    "ffmpeg",
-                    "-ss",
-                    startTime,
-                    "-to",
-                    endTime,  # --ss -to needs to be prior to -i
-                    "-i",
-                    m4aFile,
-                    "-c:a",
-                    "copy",
-                    "-metadata",
-                    f"track={track}",
-                    "-metadata",
-                    f"title={title}",
-                    "-metadata",
-                    f"artist={artist}",
-                    "-metadata",
-                    f"album_artist={artist}",
-                    "-metadata",
-                    f"album={album}",
-                    "-loglevel",
-                    "warning",
-                    path.join(extractDir, fileName),
-                ]
-            ).decode("utf-8")
-            printLogP(out)
+            tasks.append((track, title, artist, album, extractDir))
+
+    if cueParts:
+        with open(dirPath.joinpath(f"{baseName}.cue"), "w") as f:
+            f.write("".join(cueParts))
+
+    if tasks:
+        # Started only once every chapter has been read, so a malformed
+        # chapter can not leave a running ffmpeg or stray segments behind.
+        splitProc = splitChapters(m4aFile, js["chapters"], extractDir)
+        printLogP("\n\n------------------------------")
+        printLogP(f"\n\nSplitting {m4aFile.name}")
+        # Relayed line by line as ffmpeg runs instead of buffered until exit.
+        for line in splitProc.stdout:
+            printLogP(f"\n{line.rstrip()}")
+        if splitProc.wait():
+            printLogP(f"\n\nffmpeg exited with code {splitProc.returncode}")
+            log.close()
+            raise subprocess.CalledProcessError(splitProc.returncode, splitProc.args)
+        segments = getSegments(extractDir)
+        if len(segments) < len(tasks):
+            printLogP(
+                f"\n\nOnly {len(segments)} of {len(tasks)} chapters"
+                f" found in {m4aFile.name}"
+            )
+        for segment in segments[len(tasks) :]:
+            printLogP(f"\n\nRemoving extra segment {path.basename(segment)}")
+            os.remove(segment)
+        tasks = [(segment, *task) for segment, task in zip(segments, tasks)]
+
+    if tasks:
+        # map() yields in submission order so the log stays in track order.
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for track, fileName in executor.map(tagChapter, tasks):
+                printLogP(f"\n\nOutput file name: {fileName}")
 
     log.close()
     if pargs.wait: